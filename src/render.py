@@ -1,13 +1,17 @@
 import atexit
+import errno
 import logging
 import os
+import selectors
+import shlex
+import shutil
 import subprocess
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
-from threading import Thread
+from threading import Lock, Thread
 
-import psutil
 from PySide6.QtCore import *
 
 from const import *
@@ -16,104 +20,432 @@ from song_tree_widget_item import *
 
 logger = logging.getLogger(APPLICATION)
 
-PROCESSES = []
+# pid -> Popen of every running process
+PROCESSES = {}
+PROCESSES_LOCK = Lock()
+
+# fields whose value is several command arguments,
+# e.g. audioCodec is "flac -sample_fmt s32" when an
+# album is rendered as a single video
+ARGUMENT_LIST_FIELDS = {"audioCodec"}
+
+# bytes to read from an ffmpeg pipe at a time
+READ_SIZE = 65536
+
+# minimum seconds between progress updates for a single process
+PROGRESS_INTERVAL = 0.05
+
+# milliseconds between progress signals sent to the GUI
+PROGRESS_FLUSH_INTERVAL_MS = 50
+
+# threads used to delete rendered songs
+# after they are combined into an album
+REMOVE_WORKERS = 8
+
+if os.name == "nt":
+    import ctypes
+    from ctypes import wintypes
+
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _kernel32.CreateJobObjectW.argtypes = [wintypes.LPVOID, wintypes.LPCWSTR]
+    _kernel32.CreateJobObjectW.restype = wintypes.HANDLE
+    _kernel32.AssignProcessToJobObject.argtypes = [wintypes.HANDLE, wintypes.HANDLE]
+    _kernel32.AssignProcessToJobObject.restype = wintypes.BOOL
+    _kernel32.TerminateJobObject.argtypes = [wintypes.HANDLE, wintypes.UINT]
+    _kernel32.TerminateJobObject.restype = wintypes.BOOL
+
+    # every ffmpeg process gets assigned to this job
+    # so that the whole tree can be killed with one call
+    JOB = _kernel32.CreateJobObjectW(None, None)
+
+
+def track_process(p: subprocess.Popen):
+    """Registers a process so that it is killed by clean_up"""
+    if os.name == "nt" and JOB:
+        if not _kernel32.AssignProcessToJobObject(JOB, int(p._handle)):
+            # e.g. access denied, clean_up still kills it directly
+            logger.debug(
+                "Could not assign process {} to job: {}".format(
+                    p.pid, ctypes.WinError(ctypes.get_last_error())
+                )
+            )
+    with PROCESSES_LOCK:
+        PROCESSES[p.pid] = p
+
+
+def untrack_process(p: subprocess.Popen):
+    """Unregisters a process which has exited"""
+    with PROCESSES_LOCK:
+        PROCESSES.pop(p.pid, None)
+
 
 # make sure to stop all the ffmpeg processes from running
 # if we close the application
 def clean_up():
-    for p in PROCESSES:
+    if os.name == "nt" and JOB:
+        _kernel32.TerminateJobObject(JOB, 1)
+    # also kill every process directly in case
+    # it could not be assigned to the job
+    with PROCESSES_LOCK:
+        processes = list(PROCESSES.values())
+    # commands are run without a shell so
+    # each process is ffmpeg itself, not a parent of it
+    for p in processes:
         try:
-            process = psutil.Process(p.pid)
-            for proc in process.children(recursive=True):
-                proc.kill()
-            process.kill()
-        except:
+            p.kill()
+        except OSError:
             pass
 
 
 atexit.register(clean_up)
 
 
-class ProcessHandler(QObject):
+def split_command(command: str):
+    """Splits a command template into arguments like a shell would.
+
+    On Windows backslashes are kept as they are, since they are path
+    separators there. Quotes are only removed when they surround a whole
+    argument, so write "{fileOutput}" rather than out="{fileOutput}"."""
+    if os.name != "nt":
+        return shlex.split(command)
+    lexer = shlex.shlex(command, posix=False)
+    lexer.whitespace_split = True
+    lexer.commenters = ""
+    return [
+        arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1] and arg[0] in "\"'" else arg
+        for arg in lexer
+    ]
+
+
+def format_command(command: str, **kwargs):
+    """Splits a command template into an argv list and fills in each argument.
+
+    The template is tokenized before formatting so that substituted values
+    (e.g. file paths) never need to be quoted for a shell. Fields listed in
+    ARGUMENT_LIST_FIELDS hold several arguments and are split into them."""
+    args = []
+    for arg in split_command(command):
+        field = arg[1:-1] if arg.startswith("{") and arg.endswith("}") else None
+        if field in ARGUMENT_LIST_FIELDS:
+            args.extend(split_command(str(kwargs[field])))
+        else:
+            args.append(arg.format(**kwargs))
+    return args
+
+
+def whitelist_concat_pipe(command: list):
+    """Allows the concat list read from stdin to open local files.
+
+    ffmpeg only lets inputs opened through pipe: use the crypto and
+    data protocols, and the concat demuxer inherits that whitelist."""
+    if "-protocol_whitelist" in command:
+        return command
+    for i in range(len(command) - 1):
+        if command[i] == "-i" and command[i + 1] == "pipe:0":
+            return command[:i] + ["-protocol_whitelist", "file,pipe"] + command[i:]
+    return command
+
+
+def resolve_executable(command: list):
+    """Replaces the program name of the command with its full path.
+
+    subprocess only uses the posix_spawn fast path (instead of fork + exec)
+    when given a path to the executable."""
+    if os.name != "nt" and command and not os.path.dirname(command[0]):
+        path = shutil.which(command[0])
+        if path is not None:
+            return [path] + command[1:]
+    return command
 
-    stdout = Signal(str)
-    stderr = Signal(str)
+
+def concat_list_entry(path: str):
+    """Returns the ffmpeg concat demuxer line for the given file"""
+    if "'" in path:
+        # the demuxer has no escape inside quotes,
+        # so close the quote, add an escaped one and reopen it
+        path = path.replace("'", "'\\''")
+    return b"file 'file:" + path.encode("utf-8") + b"'\n"
+
+
+def remove_file(path: str):
+    """Deletes the given file, ignoring errors"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def ffmpeg_thread_count():
+    """Returns how many threads each render process may use so that
+    running maxProcesses of them at once doesn't oversubscribe the CPU"""
+    return max(1, (os.cpu_count() or 1) // int(get_setting("maxProcesses")))
+
+
+def read_pipe(pipe, queue):
+    """Puts the chunks read from pipe on queue like PipePump does,
+    using a thread of its own"""
+    try:
+        with pipe:
+            fd = pipe.fileno()
+            while chunk := os.read(fd, READ_SIZE):
+                queue.put((pipe, chunk))
+    finally:
+        queue.put((None, None))
+
+
+class PipePump(Thread):
+    """Reads the output pipes of every running process from a single thread.
+
+    Each registered pipe has its chunks put on its queue as (pipe, chunk),
+    followed by one (None, None) once the pipe is closed. If the pump
+    fails, its pipes are handed over to read_pipe threads instead."""
 
     def __init__(self):
-        super().__init__()
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        # pipes are only (un)registered from the pump thread,
+        # other threads hand them over through this queue
+        self.pending = Queue()
+        self.wake_read, self.wake_write = os.pipe()
+        self.selector.register(self.wake_read, selectors.EVENT_READ)
+        # fd -> (pipe, queue) of every pipe taken from pending
+        # which hasn't had its (None, None) posted yet
+        self.pipes = {}
+        self.lock = Lock()
+        self.failed = False
+
+    def register(self, pipe, queue):
+        with self.lock:
+            if not self.failed:
+                self.pending.put((pipe, queue))
+                os.write(self.wake_write, b"\0")
+                return
+        Thread(target=read_pipe, args=[pipe, queue]).start()
 
-    def read_pipe(self, pipe, queue):
+    def run(self):
         try:
-            with pipe:
-                for line in iter(pipe.readline, b""):
-                    queue.put((pipe, line.decode("utf-8")))
-        finally:
-            queue.put((None, None))
+            self.pump()
+        except Exception:
+            logger.exception("Pipe pump failed, reading pipes with threads instead")
+            self.fail_over()
+
+    def pump(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    os.read(self.wake_read, READ_SIZE)
+                    while not self.pending.empty():
+                        pipe, queue = self.pending.get()
+                        self.pipes[pipe.fileno()] = (pipe, queue)
+                        self.selector.register(
+                            pipe.fileno(), selectors.EVENT_READ, (pipe, queue)
+                        )
+                    continue
+                pipe, queue = key.data
+                try:
+                    chunk = os.read(key.fd, READ_SIZE)
+                except OSError:
+                    chunk = b""
+                if chunk:
+                    queue.put((pipe, chunk))
+                else:
+                    self.selector.unregister(key.fd)
+                    pipe.close()
+                    queue.put((None, None))
+                    del self.pipes[key.fd]
+
+    def fail_over(self):
+        global PUMP
+        with self.lock:
+            self.failed = True
+            pipes = list(self.pipes.values())
+            while not self.pending.empty():
+                pipes.append(self.pending.get())
+        with PUMP_LOCK:
+            if PUMP is self:
+                PUMP = None
+        for pipe, queue in pipes:
+            Thread(target=read_pipe, args=[pipe, queue]).start()
+        self.selector.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+
+
+PUMP = None
+PUMP_LOCK = Lock()
+
+
+def get_pipe_pump():
+    """Returns the PipePump, starting a new one if there is none"""
+    global PUMP
+    with PUMP_LOCK:
+        if PUMP is None:
+            PUMP = PipePump()
+            PUMP.start()
+        return PUMP
+
 
-    def run(self, command):
+class WorkerSignals(QObject):
+    finished = Signal(bool)
+    error = Signal(str)
+    progress = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+
+
+class ProcessWorker(QRunnable):
+    """Base class for workers which run an external process.
+
+    Process stderr is emitted on signals.error
+    and progress lines from stdout on signals.progress."""
+
+    def __init__(self):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.setAutoDelete(False)
 
+    @staticmethod
+    def last_progress_line(text):
+        # ffmpeg writes a whole block of key=value lines for every
+        # progress update but only the latest out_time_us matters
+        start = text.rfind("out_time_us=")
+        if start == -1:
+            return None
+        end = text.find("\n", start)
+        return text[start:] if end == -1 else text[start:end]
+
+    def write_stdin(self, pipe, data):
+        try:
+            with pipe:
+                pipe.write(data)
+        except BrokenPipeError:
+            # process exited without reading all of its input,
+            # its exit code will tell us what went wrong
+            pass
+        except OSError as e:
+            # windows raises EINVAL instead of EPIPE
+            if e.errno != errno.EINVAL:
+                raise
+
+    def run_process(self, command, stdin_bytes=None):
+        """Runs the given command, returns True if it failed"""
+        stdin = subprocess.DEVNULL if stdin_bytes is None else subprocess.PIPE
         if os.name == "nt":
             p = subprocess.Popen(
                 command,
-                stdin=subprocess.DEVNULL,
+                stdin=stdin,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 creationflags=subprocess.CREATE_NO_WINDOW,
-                shell=True,
             )
         else:
+            # close_fds=False is required for posix_spawn, this is safe
+            # because python creates its file descriptors non-inheritable
             p = subprocess.Popen(
-                command,
-                stdin=subprocess.DEVNULL,
+                resolve_executable(command),
+                stdin=stdin,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                shell=True,
+                close_fds=False,
             )
 
-        PROCESSES.append(p)
+        track_process(p)
+        try:
+            return self.communicate(p, stdin_bytes)
+        finally:
+            untrack_process(p)
+
+    def communicate(self, p, stdin_bytes):
+        """Forwards the output of the running process to the signals
+        until it exits, returns True if it failed"""
         q = Queue()
-        Thread(target=self.read_pipe, args=[p.stdout, q]).start()
-        Thread(target=self.read_pipe, args=[p.stderr, q]).start()
-        while True:
-            while q.empty() or (item := q.get_nowait()) is None:
-                time.sleep(0.01)
-            pipe, line = item
-            if pipe is None:
-                break
+        if os.name == "nt":
+            # selectors only support sockets on Windows
+            Thread(target=read_pipe, args=[p.stdout, q]).start()
+            Thread(target=read_pipe, args=[p.stderr, q]).start()
+        else:
+            pump = get_pipe_pump()
+            pump.register(p.stdout, q)
+            pump.register(p.stderr, q)
+        if stdin_bytes is not None:
+            # readers are already draining stdout/stderr,
+            # so ffmpeg can't block on output while we write
+            self.write_stdin(p.stdin, stdin_bytes)
+
+        # pipe -> bytes received after the last complete line
+        partial = {p.stdout: bytearray(), p.stderr: bytearray()}
+        pending_progress = None
+        last_progress_time = 0
+
+        def handle_output(pipe, text):
+            nonlocal pending_progress
             if pipe == p.stdout:
-                self.stdout.emit(line)
+                pending_progress = self.last_progress_line(text) or pending_progress
             else:
-                self.stderr.emit(line)
-        error = p.wait() != 0
-        PROCESSES.remove(p)
-        return error
-
+                for line in text.splitlines():
+                    self.signals.error.emit(line)
 
-class WorkerSignals(QObject):
-    finished = Signal(bool)
-    error = Signal(str)
-    progress = Signal(str)
-
-    def __init__(self):
-        super().__init__()
-
-
-class RenderSongWorker(QRunnable):
+        # each pipe posts one (None, None) sentinel on EOF
+        sentinels = 0
+        while sentinels < 2:
+            pipe, chunk = q.get()
+            if pipe is None:
+                sentinels += 1
+                continue
+            buffer = partial[pipe]
+            buffer += chunk
+            newline = buffer.rfind(b"\n")
+            if newline == -1:
+                continue
+            # decode all complete lines at once
+            # without copying them out of the buffer first
+            with memoryview(buffer) as view:
+                text = str(view[: newline + 1], "utf-8", "replace")
+            del buffer[: newline + 1]
+            handle_output(pipe, text)
+            now = time.monotonic()
+            if (
+                pending_progress is not None
+                and now - last_progress_time >= PROGRESS_INTERVAL
+            ):
+                self.signals.progress.emit(pending_progress)
+                pending_progress = None
+                last_progress_time = now
+        for pipe, buffer in partial.items():
+            if buffer:
+                handle_output(pipe, buffer.decode("utf-8", "replace"))
+        if pending_progress is not None:
+            self.signals.progress.emit(pending_progress)
+        return p.wait() != 0
+
+
+class RenderSongWorker(ProcessWorker):
     def __init__(self, song: SongTreeWidgetItem, auto_delete):
         super().__init__()
         self.auto_delete = auto_delete
         self.song = song
         self.name = self.song.get("fileOutput")
-        self.signals = WorkerSignals()
-        self.setAutoDelete(False)
+        # format the command now, while the job is being scheduled,
+        # so the worker thread doesn't have to walk the song's settings
+        # (a bad template is reported when the worker runs)
+        self.command = None
+        self.command_error = None
+        try:
+            self.command = format_command(
+                self.song.get("commandString"),
+                **{"threads": ffmpeg_thread_count(), **self.song.to_dict()},
+            )
+        except Exception:
+            self.command_error = traceback.format_exc()
 
     def run(self):
+        if self.command_error is not None:
+            self.signals.error.emit(self.command_error)
+            self.signals.finished.emit(False)
+            return
         try:
-            command_str = (self.song.get("commandString")).format(**self.song.to_dict())
-            handler = ProcessHandler()
-            handler.stderr.connect(self.signals.error.emit)
-            handler.stdout.connect(self.signals.progress.emit)
-            errors = handler.run(command_str)
+            errors = self.run_process(self.command)
             self.signals.finished.emit(not errors)
         except Exception as e:
             self.signals.error.emit(traceback.format_exc())
@@ -126,41 +458,35 @@ class RenderSongWorker(QRunnable):
         return self.name
 
 
-class CombineSongWorker(QRunnable):
+class CombineSongWorker(ProcessWorker):
     def __init__(self, album: AlbumTreeWidgetItem):
         super().__init__()
         self.auto_delete = True
         self.album = album
         self.name = self.album.get("fileOutput")
-        self.signals = WorkerSignals()
-        self.setAutoDelete(False)
 
     def run(self):
         try:
-            song_list = QTemporaryFile()
-            song_list.open(QIODevice.WriteOnly | QIODevice.Append | QIODevice.Text)
-            for song in self.album.getChildren():
-                song_list.write(
-                    QByteArray(
-                        "file 'file:{}'\n".format(
-                            song.get("fileOutput").replace("'", "'\\''")
-                        )
-                    )
-                )
-            song_list.close()
-            command_str = self.album.get("concatCommandString").format(
-                input_file_list=song_list.fileName(),
+            # concat demuxer list, piped to ffmpeg's stdin
+            song_list = b"".join(
+                concat_list_entry(song.get("fileOutput"))
+                for song in self.album.getChildren()
+            )
+            command = format_command(
+                self.album.get("concatCommandString"),
+                input_file_list="pipe:0",
                 fileOutputPath=self.album.get("fileOutput"),
+                # concatenation is a stream copy,
+                # more threads won't make it faster
+                threads=1,
             )
-            handler = ProcessHandler()
-            handler.stderr.connect(self.signals.error.emit)
-            handler.stdout.connect(self.signals.progress.emit)
-            errors = handler.run(command_str)
-            for song in self.album.getChildren():
-                try:
-                    os.remove(song.get("fileOutput"))
-                except:
-                    pass
+            command = whitelist_concat_pipe(command)
+            errors = self.run_process(command, song_list)
+            with ThreadPoolExecutor(max_workers=REMOVE_WORKERS) as executor:
+                executor.map(
+                    remove_file,
+                    [song.get("fileOutput") for song in self.album.getChildren()],
+                )
             self.signals.finished.emit(not errors)
         except Exception as e:
             self.signals.error.emit(traceback.format_exc())
@@ -193,11 +519,11 @@ class AlbumRenderHelper:
             self.renderer.start_worker(self.combine_worker)
 
     def render(self, renderer):
-        renderer.worker_done.connect(self.worker_done)
         for song in self.album.getChildren():
             song.before_render()
             worker = renderer.add_render_song_job(song, auto_delete=False)
             self.workers.add(worker)
+            renderer.album_helpers[worker] = self
         self.combine_worker = renderer.combine_songs_into_album(self.album)
         self.renderer = renderer
         return self
@@ -226,6 +552,10 @@ class Renderer(QObject):
         # don't get garbage collected
         self.helpers = []
 
+        # worker name -> AlbumRenderHelper
+        # which is waiting on that worker
+        self.album_helpers = {}
+
         # worker name -> QRunnable
         self.workers = {}
 
@@ -233,6 +563,11 @@ class Renderer(QObject):
         # workers which are not in the thread pool yet
         self.queued_workers = {}
 
+        # workers added before render() was called,
+        # they are all started together once it is
+        self.unstarted_workers = []
+        self.started = False
+
         # finished workers that still need to be held onto
         # so that resources don't go out of scope
         self.finished_workers = []
@@ -240,27 +575,58 @@ class Renderer(QObject):
         # output file -> success
         self.results = {}
 
+        # worker name -> 100 / duration in ms
+        # so progress percentage is just a multiply
+        self.duration_recip = {}
+
+        # worker name -> progress not emitted yet
+        self.progress_dirty = {}
+
+        # worker name -> last emitted progress
+        self.progress_emitted = {}
+
+        # progress is emitted in batches so that
+        # chatty workers don't flood the GUI thread
+        self.progress_timer = QTimer(self)
+        self.progress_timer.setInterval(PROGRESS_FLUSH_INTERVAL_MS)
+        self.progress_timer.timeout.connect(self._flush_progress)
+
         self.cancelled = False
 
     def _worker_progress(self, worker, progress):
+        if not progress.startswith("out_time_us="):
+            return
         try:
-            key, value = progress.strip().split("=")
-            if key == "out_time_us":
-                current_time_ms = int(value) // 1000
-                total_time_ms = worker.get_duration_ms()
-                progress = max(
-                    0, min(int((current_time_ms / total_time_ms) * 100), 100)
-                )
-                self.worker_progress.emit(str(worker), progress)
-        except:
+            current_time_us = int(progress[12:].rstrip())
+        except ValueError:
             logger.warning("Could not parse worker_progress line: {}".format(progress))
+            return
+        progress = int(current_time_us * 0.001 * self.duration_recip[str(worker)])
+        self.progress_dirty[str(worker)] = max(0, min(progress, 100))
+        if not self.progress_timer.isActive():
+            self.progress_timer.start()
+
+    def _flush_progress(self):
+        if len(self.progress_dirty) == 0:
+            self.progress_timer.stop()
+            return
+        dirty, self.progress_dirty = self.progress_dirty, {}
+        for worker_name, progress in dirty.items():
+            if self.progress_emitted.get(worker_name) != progress:
+                self.progress_emitted[worker_name] = progress
+                self.worker_progress.emit(worker_name, progress)
 
     def worker_finished(self, worker, success):
+        # don't report progress for a worker that is already done
+        self.progress_dirty.pop(str(worker), None)
         self.results[str(worker)] = success
         self.workers.pop(str(worker), None)
         if not self.cancelled:
             if not worker.auto_delete:
                 self.finished_workers.append(worker)
+            helper = self.album_helpers.pop(str(worker), None)
+            if helper is not None:
+                helper.worker_done(str(worker), success)
             self.worker_done.emit(str(worker), success)
             logger.debug("{} finished, success: {}".format(str(worker), success))
             if len(self.workers) == 0:
@@ -286,6 +652,7 @@ class Renderer(QObject):
         self.queued_workers.pop(worker_name, None)
 
     def add_worker(self, worker, auto_start=True):
+        self.duration_recip[str(worker)] = 100.0 / max(1, worker.get_duration_ms())
         worker.signals.finished.connect(
             lambda success, worker=worker: self.worker_finished(worker, success)
         )
@@ -297,7 +664,10 @@ class Renderer(QObject):
         )
         if auto_start:
             self.workers[str(worker)] = worker
-            QThreadPool.globalInstance().start(worker)
+            if self.started:
+                QThreadPool.globalInstance().start(worker)
+            else:
+                self.unstarted_workers.append(worker)
         else:
             self.queued_workers[str(worker)] = worker
 
@@ -325,12 +695,21 @@ class Renderer(QObject):
         return str(worker)
 
     def render(self):
+        # all the per-job setup is already done,
+        # so the processes get launched back to back
+        self.started = True
+        pool = QThreadPool.globalInstance()
+        for worker in self.unstarted_workers:
+            pool.start(worker)
+        self.unstarted_workers = []
         if len(self.workers) == 0 and len(self.finished_workers) == 0:
             self.finished.emit(self.results)
 
     def cancel(self):
         clean_up()
         self.cancelled = True
+        self.progress_timer.stop()
+        self.progress_dirty = {}
         for worker in self.workers:
             if str(worker) not in self.results:
                 self.results[str(worker)] = False